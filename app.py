@@ -1,15 +1,35 @@
 import os
 import time
-import json
-import requests
-from typing import Dict, List, Any, Optional
-
-from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import PlainTextResponse, JSONResponse
+import queue
+import hashlib
+import asyncio
+import logging
+import httpx
+import orjson
+import redis.asyncio as aioredis
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Any, Optional, Set, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, ORJSONResponse
 
 # ================== НАСТРОЙКИ И СТАРТ ==================
 
-app = FastAPI()
+# Логи пишутся в очередь, а в stderr их выводит отдельный поток слушателя —
+# event loop не блокируется на записи. Уровень: LOG_LEVEL (по умолчанию INFO).
+# Слушатель запускается/останавливается в lifespan; записи, сделанные до старта,
+# ждут в очереди.
+logger = logging.getLogger("gbot")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+_LOG_QUEUE: queue.SimpleQueue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_LOG_QUEUE))
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+LOG_LISTENER = QueueListener(_LOG_QUEUE, _log_stream)
 
 STRAVA_CLIENT_ID = os.getenv("STRAVA_CLIENT_ID")
 STRAVA_CLIENT_SECRET = os.getenv("STRAVA_CLIENT_SECRET")
@@ -18,12 +38,270 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 STRAVA_TOKEN_URL = "https://www.strava.com/oauth/token"
 STRAVA_API = "https://www.strava.com/api/v3"
 
-# In-memory хранилище токенов: athlete_id -> {access, refresh, expires_at}
-TOKENS: Dict[int, Dict[str, Any]] = {}
+UTC = timezone.utc
+WEEK = timedelta(days=7)
+
+# Общий async-клиент (keep-alive + HTTP/2) для Strava / OpenAI / Telegram.
+# Создаётся на старте приложения, закрывается на shutdown.
+HTTPX: Optional[httpx.AsyncClient] = None
+
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+BACKGROUND_TASKS: Set[asyncio.Task] = set()
+# Сколько на shutdown ждём недоделанные process_activity / send_tg
+SHUTDOWN_GRACE_S = 10.0
+
+# Не больше 20 одновременных запросов в Telegram (создаётся в lifespan)
+TG_SEM: Optional[asyncio.Semaphore] = None
+
+# Сырые тела вебхуков: эндпоинт только кладёт их сюда и сразу отвечает 200,
+# разбором занимается consume_webhooks. Создаётся в lifespan.
+WEBHOOK_QUEUE_MAX = 1000
+WEBHOOK_QUEUE: Optional[asyncio.Queue] = None
+
+# Очередь-дебаунс вебхуков: (owner_id, activity_id) -> время последнего события.
+# Strava часто шлёт create + update подряд — склеиваем их в одну обработку.
+DEBOUNCE_S = 2.0
+PENDING: Dict[Tuple[int, int], float] = {}
+
+# LRU+TTL кэш сводки недели по /athlete/activities: athlete_id -> (ts, week_summary).
+# Сам список не храним — нужна только сводка.
+# Вебхуки одного атлета идут пачками, а лимит Strava — 100 запросов / 15 мин.
+SUMMARY_TTL_S = 90.0
+SUMMARY_CACHE_MAX = 512
+SUMMARY_CACHE: OrderedDict[int, Tuple[float, Dict[str, Any]]] = OrderedDict()
+# Поколение сводки на время запроса: athlete_id -> [generation, запросов в полёте].
+# Вебхук, пришедший во время запроса, поднимает generation — и устаревший
+# результат не попадает в кэш. Запись удаляется, когда запросов не осталось.
+SUMMARY_GEN: Dict[int, List[int]] = {}
+
+# Кэш ответов GPT: blake2b(prompt) -> (ts, advice). Повторный вебхук с той же
+# активностью и сводкой даёт тот же промпт — не платим за него OpenAI ещё раз.
+ADVICE_TTL_S = 600.0
+ADVICE_CACHE_MAX = 1000
+ADVICE_CACHE: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+
+# In-memory хранилище токенов (без REDIS_URL): athlete_id -> {access, refresh, expires_at}
+# Ограничено MAX_ATHLETES записями, вытесняется самый давно использованный атлет.
+MAX_ATHLETES = 10_000
+TOKENS: OrderedDict[int, Dict[str, Any]] = OrderedDict()
+# Порядок TOKENS — LRU, поэтому первого подключённого атлета (для /plan/weekly)
+# запоминаем отдельно
+FIRST_ATHLETE_ID: Optional[int] = None
+# По замку на атлета: параллельные refresh'и схлопываются в один запрос
+LOCKS: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Если задан REDIS_URL — токены живут в Redis и общие для всех воркеров/реплик:
+# strava:token:{athlete_id} -> hash {access, refresh, expires_at}
+# strava:athletes:connected -> zset athlete_id, score = время первого OAuth
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS: Optional[aioredis.Redis] = None
+TOKEN_KEY = "strava:token:{}"
+ATHLETES_KEY = "strava:athletes:connected"
+TOKEN_TTL_S = 180 * 24 * 3600
+
+logger.info("[ENV] STRAVA_CLIENT_ID: %s", STRAVA_CLIENT_ID)
+logger.info("[ENV] STRAVA_CLIENT_SECRET set: %s", bool(STRAVA_CLIENT_SECRET))
+logger.info("[ENV] OPENAI_API_KEY set: %s", bool(OPENAI_API_KEY))
+logger.info("[ENV] REDIS_URL set: %s", bool(REDIS_URL))
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global HTTPX, REDIS, TG_SEM, WEBHOOK_QUEUE
+    LOG_LISTENER.start()
+    TG_SEM = asyncio.Semaphore(20)
+    WEBHOOK_QUEUE = asyncio.Queue(maxsize=WEBHOOK_QUEUE_MAX)
+    HTTPX = httpx.AsyncClient(
+        http2=True,
+        timeout=15,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    )
+    if REDIS_URL:
+        REDIS = aioredis.Redis.from_url(REDIS_URL, decode_responses=True)
+    loops = [spawn(consume_webhooks()), spawn(flush_pending())]
+
+    yield
+
+    for task in loops:
+        task.cancel()
+    # разбираем то, что осталось в очереди: Strava уже получила 200
+    while not WEBHOOK_QUEUE.empty():
+        try:
+            handle_webhook_event(orjson.loads(WEBHOOK_QUEUE.get_nowait()))
+        except Exception as e:
+            logger.error("[WEBHOOK] ERROR handling event: %r", e)
+    # события уже подтверждены Strava — обрабатываем их, не дожидаясь окна дебаунса
+    for key in list(PENDING):
+        del PENDING[key]
+        spawn(process_activity(*key))
+    await drain_background_tasks(SHUTDOWN_GRACE_S)
+    await HTTPX.aclose()
+    if REDIS is not None:
+        await REDIS.aclose()
+    LOG_LISTENER.stop()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+
+def spawn(coro) -> asyncio.Task:
+    """
+    Запускает корутину в фоне на event loop'е и держит ссылку на задачу.
+    """
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+
+async def drain_background_tasks(timeout: float) -> None:
+    """
+    Даёт фоновым задачам (и тем, что они успеют запустить) доработать
+    до timeout секунд, остальные отменяет — до закрытия HTTPX.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        pending = {t for t in BACKGROUND_TASKS if not t.done()}
+        remaining = deadline - time.monotonic()
+        if not pending or remaining <= 0:
+            break
+        await asyncio.wait(pending, timeout=remaining)
+
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def flush_pending():
+    """
+    Раз в DEBOUNCE_S секунд забирает из PENDING события, которые «отлежались»
+    дольше окна, и запускает process_activity по одному разу на ключ.
+    """
+    while True:
+        await asyncio.sleep(DEBOUNCE_S)
+        cutoff = time.monotonic() - DEBOUNCE_S
+        ready = [key for key, ts in PENDING.items() if ts <= cutoff]
+        for key in ready:
+            del PENDING[key]
+            spawn(process_activity(*key))
+
+
+# ================== HTTP: РЕТРАИ И CIRCUIT BREAKER ==================
 
-print("[ENV] STRAVA_CLIENT_ID:", STRAVA_CLIENT_ID)
-print("[ENV] STRAVA_CLIENT_SECRET set:", bool(STRAVA_CLIENT_SECRET))
-print("[ENV] OPENAI_API_KEY set:", bool(OPENAI_API_KEY))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Неидемпотентные запросы (POST) повторяем, только если сервер их точно
+# не обработал: соединение не установлено, либо явный 429/503.
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+UNSAFE_RETRY_STATUSES = (429, 503)
+RETRY_TOTAL = 3
+RETRY_BACKOFF_S = 0.5
+RETRY_AFTER_MAX_S = 30.0
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    После fail_max подряд неудачных запросов к хосту перестаём туда ходить
+    на reset_timeout секунд, потом пропускаем ровно один пробный запрос:
+    успех закрывает breaker, неудача снова открывает его на reset_timeout.
+    """
+
+    def __init__(self, name: str, fail_max: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_timeout:
+            return False
+        # half-open: пропускаем пробу, остальных держим ещё reset_timeout
+        # (в том числе если проба так и не отчиталась success/failure)
+        self.opened_at = now
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.fail_max:
+            if self.opened_at is None:
+                logger.warning("[BREAKER] %s: circuit open", self.name)
+            self.opened_at = time.monotonic()
+
+
+STRAVA_BREAKER = CircuitBreaker("strava")
+OPENAI_BREAKER = CircuitBreaker("openai")
+
+
+def retry_delay(r: Optional[httpx.Response], attempt: int) -> float:
+    if r is not None:
+        retry_after = r.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), RETRY_AFTER_MAX_S)
+    return RETRY_BACKOFF_S * (2 ** attempt)
+
+
+async def request_with_retry(
+    breaker: CircuitBreaker,
+    method: str,
+    url: str,
+    stream: bool = False,
+    idempotent: Optional[bool] = None,
+    **kwargs: Any,
+) -> httpx.Response:
+    """
+    HTTPX.request с экспоненциальным backoff'ом на 429/5xx и сетевые ошибки.
+    Неидемпотентные запросы (по умолчанию всё, кроме GET/HEAD) повторяются
+    только на UNSENT_ERRORS и UNSAFE_RETRY_STATUSES.
+    Пока breaker открыт — сразу CircuitOpenError, без похода в сеть.
+    При stream=True тело не читается — ответ закрывает вызывающий (aclose),
+    и он же отмечает breaker.success()/failure() для 200 после чтения потока.
+    """
+    if not breaker.allow():
+        raise CircuitOpenError(f"{breaker.name}: circuit open")
+    if idempotent is None:
+        idempotent = method in ("GET", "HEAD")
+    retry_statuses = RETRY_STATUSES if idempotent else UNSAFE_RETRY_STATUSES
+
+    attempt = 0
+    while True:
+        try:
+            request = HTTPX.build_request(method, url, **kwargs)
+            r = await HTTPX.send(request, stream=stream)
+        except httpx.TransportError as e:
+            retryable = idempotent or isinstance(e, UNSENT_ERRORS)
+            if attempt >= RETRY_TOTAL or not retryable:
+                breaker.failure()
+                raise
+            reason = repr(e)
+            delay = retry_delay(None, attempt)
+        else:
+            if r.status_code not in RETRY_STATUSES:
+                if not (stream and r.status_code == 200):
+                    breaker.success()
+                return r
+            if attempt >= RETRY_TOTAL or r.status_code not in retry_statuses:
+                breaker.failure()
+                return r
+            reason = f"HTTP {r.status_code}"
+            delay = retry_delay(r, attempt)
+            await r.aclose()
+
+        attempt += 1
+        logger.info(
+            "[RETRY] %s %s: %s, attempt %d in %.1fs", method, url, reason, attempt, delay
+        )
+        await asyncio.sleep(delay)
 
 
 # ================== БАЗОВЫЕ ЭНДПОИНТЫ ==================
@@ -54,48 +332,73 @@ def verify(request: Request):
         or request.query_params.get("hub_challenge")
         or request.query_params.get("challenge")
     )
-    print("[VERIFY] hub.challenge =", challenge)
-    return JSONResponse({"hub.challenge": challenge or ""}, status_code=200)
+    logger.info("[VERIFY] hub.challenge = %s", challenge)
+    return ORJSONResponse({"hub.challenge": challenge or ""}, status_code=200)
 
 
 # ================== STRAVA WEBHOOK EVENTS (POST) ==================
 
 
 @app.post("/strava/webhook")
-async def webhook(req: Request, background_tasks: BackgroundTasks):
-    payload = await req.json()
-    print("=== WEBHOOK IN ===")
-    print(payload)
-    print("==================")
+async def webhook(req: Request):
+    body = await req.body()
+    try:
+        WEBHOOK_QUEUE.put_nowait(body)
+    except asyncio.QueueFull:
+        # не 200 — Strava повторит событие позже
+        logger.warning("[WEBHOOK] queue full, event rejected")
+        return PlainTextResponse("busy", status_code=503)
+    return {"ok": True}
+
+
+async def consume_webhooks():
+    """
+    Разбирает тела вебхуков из WEBHOOK_QUEUE уже после ответа Strava.
+    """
+    while True:
+        try:
+            body = await WEBHOOK_QUEUE.get()
+            handle_webhook_event(orjson.loads(body))
+        except Exception as e:
+            # цикл не должен умирать: иначе события подтверждены, но потеряны
+            logger.error("[WEBHOOK] ERROR handling event: %r", e)
+
+
+def handle_webhook_event(payload: Dict[str, Any]) -> None:
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[WEBHOOK] payload: %s", payload)
 
     object_type = payload.get("object_type")
     aspect_type = payload.get("aspect_type")
     owner_id = payload.get("owner_id")
     activity_id = payload.get("object_id")
 
-    print(f"[WEBHOOK] object_type={object_type} aspect_type={aspect_type} "
-          f"owner={owner_id} activity={activity_id}")
+    logger.info(
+        "[WEBHOOK] object_type=%s aspect_type=%s owner=%s activity=%s",
+        object_type, aspect_type, owner_id, activity_id,
+    )
+
+    if object_type == "activity":
+        # новая, изменённая или удалённая тренировка меняет сводку недели
+        invalidate_week_summary(owner_id)
 
     if object_type == "activity" and aspect_type in ("create", "update"):
-        print("[WEBHOOK] DIRECT call process_activity (debug mode)")
-        process_activity(owner_id, activity_id)
+        PENDING[(owner_id, activity_id)] = time.monotonic()
     else:
-        print("[WEBHOOK] not activity/create/update — skip")
-
-    return {"ok": True}
+        logger.debug("[WEBHOOK] not activity/create/update — skip")
 
 
 # ================== STRAVA OAUTH CALLBACK ==================
 
 
 @app.get("/strava/oauth/callback")
-def oauth_callback(code: str):
+async def oauth_callback(code: str):
     """
     Сюда приходит Strava после авторизации.
-    Обмениваем code на access/refresh токены и кладём в TOKENS.
+    Обмениваем code на access/refresh токены и сохраняем (store_tokens).
     """
-    print("[OAUTH] callback with code:", code)
-    r = requests.post(
+    logger.debug("[OAUTH] callback with code: %s", code)
+    r = await HTTPX.post(
         STRAVA_TOKEN_URL,
         data={
             "client_id": STRAVA_CLIENT_ID,
@@ -104,18 +407,19 @@ def oauth_callback(code: str):
             "grant_type": "authorization_code",
         },
     )
-    print("[OAUTH] status:", r.status_code)
-    print("[OAUTH] raw:", r.text[:1000])
+    logger.info("[OAUTH] status: %s", r.status_code)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[OAUTH] raw: %s", r.text[:1000])
 
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
     athlete_id = data["athlete"]["id"]
-    TOKENS[athlete_id] = {
+    await store_tokens(athlete_id, {
         "access": data["access_token"],
         "refresh": data["refresh_token"],
         "expires_at": data["expires_at"],
-    }
-    print(f"[OAUTH] athlete {athlete_id} tokens stored")
+    })
+    logger.info("[OAUTH] athlete %s tokens stored", athlete_id)
 
     return PlainTextResponse(f"✅ Strava подключена! Athlete ID: {athlete_id}")
 
@@ -123,33 +427,123 @@ def oauth_callback(code: str):
 # ================== РАБОТА С ТОКЕНАМИ STRAVA ==================
 
 
-def get_access_token(athlete_id: int) -> str:
+async def load_tokens(athlete_id: int) -> Optional[Dict[str, Any]]:
+    if REDIS is None:
+        t = TOKENS.get(athlete_id)
+        if t is not None:
+            TOKENS.move_to_end(athlete_id)
+        return t
+
+    h = await REDIS.hgetall(TOKEN_KEY.format(athlete_id))
+    if not h:
+        # hash истёк по TTL — атлет больше не подключён
+        await REDIS.zrem(ATHLETES_KEY, athlete_id)
+        return None
+    return {
+        "access": h["access"],
+        "refresh": h["refresh"],
+        "expires_at": int(h["expires_at"]),
+    }
+
+
+async def store_tokens(athlete_id: int, t: Dict[str, Any]) -> None:
+    """
+    Сохраняем токены атлета: в Redis (одной транзакцией) или в TOKENS,
+    вытесняя самого старого при переполнении.
+    """
+    if REDIS is not None:
+        key = TOKEN_KEY.format(athlete_id)
+        async with REDIS.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=t)
+            pipe.expire(key, TOKEN_TTL_S)
+            # nx: refresh не сдвигает время подключения
+            pipe.zadd(ATHLETES_KEY, {athlete_id: time.time()}, nx=True)
+            await pipe.execute()
+        return
+
+    global FIRST_ATHLETE_ID
+    TOKENS[athlete_id] = t
+    TOKENS.move_to_end(athlete_id)
+    if FIRST_ATHLETE_ID is None:
+        FIRST_ATHLETE_ID = athlete_id
+    if len(TOKENS) > MAX_ATHLETES:
+        evicted, _ = TOKENS.popitem(last=False)
+        LOCKS.pop(evicted, None)
+        if evicted == FIRST_ATHLETE_ID:
+            FIRST_ATHLETE_ID = next(iter(TOKENS))
+
+
+def token_expired(t: Dict[str, Any]) -> bool:
+    return time.time() > t["expires_at"] - 60
+
+
+async def any_athlete_id() -> Optional[int]:
+    if REDIS is None:
+        return FIRST_ATHLETE_ID
+    # первый подключённый атлет, у которого ещё есть токены
+    while True:
+        first = await REDIS.zrange(ATHLETES_KEY, 0, 0)
+        if not first:
+            return None
+        athlete_id = int(first[0])
+        if await load_tokens(athlete_id) is not None:
+            return athlete_id
+
+
+async def get_access_token(athlete_id: int) -> str:
     """
     Получаем access_token для атлета. При необходимости — обновляем по refresh_token.
     """
-    if athlete_id not in TOKENS:
+    t = await load_tokens(athlete_id)
+    if t is None:
         raise KeyError(f"no tokens for athlete_id={athlete_id}")
+    if not token_expired(t):
+        return t["access"]
+
+    lock = LOCKS[athlete_id]
+    try:
+        async with lock:
+            return await refresh_access_token(athlete_id)
+    finally:
+        # замок нужен только на время refresh — не копим их по всем атлетам
+        if not lock.locked() and LOCKS.get(athlete_id) is lock:
+            del LOCKS[athlete_id]
 
-    t = TOKENS[athlete_id]
-    now = time.time()
-    if now > t["expires_at"] - 60:
-        print(f"[TOKENS] refreshing token for athlete={athlete_id}")
-        rr = requests.post(
-            STRAVA_TOKEN_URL,
-            data={
-                "client_id": STRAVA_CLIENT_ID,
-                "client_secret": STRAVA_CLIENT_SECRET,
-                "grant_type": "refresh_token",
-                "refresh_token": t["refresh"],
-            },
-        )
-        print("[TOKENS] refresh status:", rr.status_code, "raw:", rr.text[:500])
-        rr.raise_for_status()
-        data = rr.json()
-        t["access"] = data["access_token"]
-        t["refresh"] = data.get("refresh_token", t["refresh"])
-        t["expires_at"] = data["expires_at"]
 
+async def refresh_access_token(athlete_id: int) -> str:
+    """
+    Обновляет access_token по refresh_token. Вызывать под LOCKS[athlete_id].
+    """
+    # пока ждали замок, токен мог обновить соседний вебхук (или другая реплика)
+    t = await load_tokens(athlete_id)
+    if t is None:
+        raise KeyError(f"no tokens for athlete_id={athlete_id}")
+    if not token_expired(t):
+        return t["access"]
+
+    logger.info("[TOKENS] refreshing token for athlete=%s", athlete_id)
+    rr = await request_with_retry(
+        STRAVA_BREAKER,
+        "POST",
+        STRAVA_TOKEN_URL,
+        data={
+            "client_id": STRAVA_CLIENT_ID,
+            "client_secret": STRAVA_CLIENT_SECRET,
+            "grant_type": "refresh_token",
+            "refresh_token": t["refresh"],
+        },
+    )
+    logger.info("[TOKENS] refresh status: %s", rr.status_code)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[TOKENS] refresh raw: %s", rr.text[:500])
+    rr.raise_for_status()
+    data = orjson.loads(rr.content)
+    t = {
+        "access": data["access_token"],
+        "refresh": data.get("refresh_token", t["refresh"]),
+        "expires_at": data["expires_at"],
+    }
+    await store_tokens(athlete_id, t)
     return t["access"]
 
 
@@ -160,27 +554,25 @@ def summarize_week(acts: List[Dict[str, Any]]) -> Dict[str, Any]:
     """
     Сводка за 7 дней по последним активностям из Strava.
     """
-    from datetime import datetime, timedelta, timezone
-
-    now = datetime.now(timezone.utc)
+    # start_date у Strava — UTC в виде "YYYY-MM-DDTHH:MM:SSZ", такие строки
+    # сортируются так же, как даты, поэтому сравниваем без парсинга.
+    cutoff = (datetime.now(UTC) - WEEK).strftime("%Y-%m-%dT%H:%M:%SZ")
+    get = dict.get
     dur = 0.0
     dist = 0.0
     elev = 0.0
     cnt = 0
 
     for x in acts:
-        try:
-            start = datetime.fromisoformat(
-                x["start_date"].replace("Z", "+00:00")
-            )
-        except Exception:
+        start = get(x, "start_date")
+        if not isinstance(start, str) or start <= cutoff:
             continue
 
-        if start > now - timedelta(days=7):
-            dur += x.get("moving_time", 0) or 0
-            dist += x.get("distance", 0.0) or 0.0
-            elev += x.get("total_elevation_gain", 0.0) or 0.0
-            cnt += 1
+        # `or 0` — Strava может вернуть null вместо числа
+        dur += get(x, "moving_time", 0) or 0
+        dist += get(x, "distance", 0.0) or 0.0
+        elev += get(x, "total_elevation_gain", 0.0) or 0.0
+        cnt += 1
 
     return {
         "workouts": cnt,
@@ -214,35 +606,104 @@ def is_moving_activity(activity: Dict[str, Any]) -> bool:
     return True
 
 
-# ================== GPT: ПРОМПТ И ВЫЗОВ OPENAI ==================
+async def fetch_activity(activity_id: int, token: str) -> Dict[str, Any]:
+    """
+    Детальная активность из Strava.
+    """
+    r_act = await request_with_retry(
+        STRAVA_BREAKER,
+        "GET",
+        f"{STRAVA_API}/activities/{activity_id}",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    logger.debug("[STRAVA] /activities status: %s", r_act.status_code)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[STRAVA] /activities raw: %s", r_act.text[:500])
+    r_act.raise_for_status()
+    return orjson.loads(r_act.content)
 
 
-def build_coach_prompt(activity: Dict[str, Any], week_summary: Dict[str, Any]) -> str:
-    goal = os.getenv("COACH_GOAL") or "цель не указана"
+def invalidate_week_summary(athlete_id: int) -> None:
+    SUMMARY_CACHE.pop(athlete_id, None)
+    state = SUMMARY_GEN.get(athlete_id)
+    if state is not None:
+        state[0] += 1
+
+
+async def fetch_week_summary(athlete_id: int, token: str) -> Dict[str, Any]:
+    """
+    Сводка недели по последним 50 активностям атлета.
+    Результат кэшируется в SUMMARY_CACHE на SUMMARY_TTL_S секунд.
+    """
+    now = time.monotonic()
+    cached = SUMMARY_CACHE.get(athlete_id)
+    if cached is not None and now - cached[0] < SUMMARY_TTL_S:
+        SUMMARY_CACHE.move_to_end(athlete_id)
+        logger.debug("[STRAVA] week summary cache hit athlete=%s", athlete_id)
+        return cached[1]
+
+    state = SUMMARY_GEN.setdefault(athlete_id, [0, 0])
+    generation = state[0]
+    state[1] += 1
+    try:
+        r_list = await request_with_retry(
+            STRAVA_BREAKER,
+            "GET",
+            f"{STRAVA_API}/athlete/activities",
+            headers={"Authorization": f"Bearer {token}"},
+            params={"per_page": 50},
+        )
+    finally:
+        state[1] -= 1
+        if state[1] == 0 and SUMMARY_GEN.get(athlete_id) is state:
+            del SUMMARY_GEN[athlete_id]
+    logger.debug("[STRAVA] /athlete/activities status: %s", r_list.status_code)
+    r_list.raise_for_status()
+    acts = orjson.loads(r_list.content)
+    logger.debug("[STRAVA] /athlete/activities count=%d", len(acts))
+
+    week_summary = summarize_week(acts)
+    if state[0] != generation:
+        # пока шёл запрос, пришёл вебхук — список мог уже устареть
+        logger.debug(
+            "[STRAVA] week summary invalidated in flight athlete=%s", athlete_id
+        )
+        return week_summary
+
+    SUMMARY_CACHE[athlete_id] = (now, week_summary)
+    SUMMARY_CACHE.move_to_end(athlete_id)
+    if len(SUMMARY_CACHE) > SUMMARY_CACHE_MAX:
+        SUMMARY_CACHE.popitem(last=False)
+    return week_summary
+
 
-    safe = {k: activity.get(k) for k in [
-        "name",
-        "type",
-        "sport_type",
-        "distance",
-        "moving_time",
-        "elapsed_time",
-        "average_speed",
-        "average_heartrate",
-        "max_heartrate",
-        "total_elevation_gain",
-        "suffer_score",
-        "start_date_local",
-    ]}
-
-    return f"""
+# ================== GPT: ПРОМПТ И ВЫЗОВ OPENAI ==================
+
+
+# Поля активности, которые уходят в промпт
+SAFE_KEYS = (
+    "name",
+    "type",
+    "sport_type",
+    "distance",
+    "moving_time",
+    "elapsed_time",
+    "average_speed",
+    "average_heartrate",
+    "max_heartrate",
+    "total_elevation_gain",
+    "suffer_score",
+    "start_date_local",
+)
+
+_COACH_PROMPT = """
 Ты — персональный тренер по выносливости (бег, трейл, вело).
 
 ЦЕЛЬ АТЛЕТА: {goal}
 
 ДАНО:
-- Текущая тренировка (основные поля из Strava): {json.dumps(safe, ensure_ascii=False)}
-- Сводка за 7 дней: {week_summary}
+- Текущая тренировка (основные поля из Strava): {safe}
+- Сводка за 7 дней: {week}
 
 ОТВЕТ СТРОГО В ДВУХ БЛОКАХ:
 
@@ -258,15 +719,80 @@ B) Конкретная рекомендация:
    - если есть риск перегруза — явно скажи, как уменьшить объём/интенсивность.
 """.strip()
 
+_WEEKLY_PROMPT = """
+Ты тренер по выносливости. На основе последних тренировок (сводка ниже)
+и цели атлета составь план на следующую неделю (5–7 дней).
 
-def ask_openai(prompt: str) -> str:
+ЦЕЛЬ: {goal}
+
+СВОДКА НЕДЕЛИ: {week}
+
+Выведи по дням:
+- ДЕНЬ недели,
+- тип тренировки,
+- длительность,
+- интенсивность (зона / RPE),
+- если нужен отдых — так и напиши.
+""".strip()
+
+
+def build_coach_prompt(activity: Dict[str, Any], week_summary: Dict[str, Any]) -> str:
+    goal = os.getenv("COACH_GOAL") or "цель не указана"
+    # пустые поля в промпт не отдаём — меньше токенов на каждый вызов GPT
+    safe = {
+        k: v for k, v in zip(SAFE_KEYS, map(activity.get, SAFE_KEYS)) if v is not None
+    }
+    # orjson не экранирует не-ASCII, как json.dumps(..., ensure_ascii=False)
+    safe_json = orjson.dumps(safe).decode()
+    return _COACH_PROMPT.format(goal=goal, safe=safe_json, week=week_summary)
+
+
+async def read_output_text(r: httpx.Response) -> str:
+    """
+    Собирает текст из SSE-потока /v1/responses (события response.output_text.delta).
+    Чанки читаются по мере генерации, event loop в это время свободен.
+    Обрезанный ответ (response.incomplete / поток без response.completed) — ошибка.
+    """
+    parts: List[str] = []
+    completed = False
+    async for line in r.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        event = orjson.loads(data)
+        etype = event.get("type")
+        if etype == "response.output_text.delta":
+            parts.append(event.get("delta", ""))
+        elif etype == "response.completed":
+            completed = True
+        elif etype in ("response.incomplete", "response.failed", "error"):
+            raise RuntimeError(f"OpenAI stream error: {data[:500]}")
+    if not completed:
+        raise RuntimeError("OpenAI stream ended without response.completed")
+    return "".join(parts).strip()
+
+
+async def ask_openai(prompt: str) -> str:
     if not OPENAI_API_KEY:
-        print("[GPT] ERROR: OPENAI_API_KEY не задан!")
+        logger.error("[GPT] OPENAI_API_KEY не задан!")
         return "Не удалось получить совет: не настроен ключ OpenAI."
 
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+    now = time.monotonic()
+    cached = ADVICE_CACHE.get(key)
+    if cached is not None:
+        if now - cached[0] < ADVICE_TTL_S:
+            ADVICE_CACHE.move_to_end(key)
+            logger.debug("[GPT] advice cache hit %s", key)
+            return cached[1]
+        del ADVICE_CACHE[key]
+
     try:
-        r = requests.post(
+        r = await request_with_retry(
+            OPENAI_BREAKER,
+            "POST",
             "https://api.openai.com/v1/responses",
+            stream=True,
             headers={
                 "Authorization": f"Bearer {OPENAI_API_KEY}",
                 "Content-Type": "application/json",
@@ -274,193 +800,179 @@ def ask_openai(prompt: str) -> str:
             json={
                 "model": "gpt-5.1",
                 "input": prompt,
+                "stream": True,
             },
             timeout=30,
         )
-        print("[GPT] HTTP status:", r.status_code)
-        print("[GPT] RAW:", r.text[:1000])
-
-        r.raise_for_status()
-        data = r.json()
-        txt = data.get("output_text", "").strip()
+        try:
+            logger.debug("[GPT] HTTP status: %s", r.status_code)
+            if r.status_code != 200:
+                await r.aread()
+                logger.error("[GPT] RAW: %s", r.text[:1000])
+                r.raise_for_status()
+            try:
+                txt = await read_output_text(r)
+            except Exception:
+                OPENAI_BREAKER.failure()
+                raise
+            OPENAI_BREAKER.success()
+        finally:
+            await r.aclose()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[GPT] TEXT: %s", txt[:1000])
         if not txt:
-            print("[GPT] WARNING: output_text пустой")
+            logger.warning("[GPT] output_text пустой")
             return "Модель вернула пустой ответ."
+
+        ADVICE_CACHE[key] = (now, txt)
+        if len(ADVICE_CACHE) > ADVICE_CACHE_MAX:
+            ADVICE_CACHE.popitem(last=False)
         return txt
     except Exception as e:
-        print("[GPT] ERROR:", repr(e))
+        logger.error("[GPT] ERROR: %r", e)
         return "Не удалось получить совет (ошибка при обращении к OpenAI)."
 
 
 # ================== ОТПРАВКА В TELEGRAM (ОПЦИОНАЛЬНО) ==================
 
 
-def send_tg(text: str, chat_id: Optional[str] = None) -> None:
+async def send_tg(text: str, chat_id: Optional[str] = None) -> None:
     token = os.getenv("TG_BOT_TOKEN")
     chat_id = chat_id or os.getenv("TG_CHAT_ID")
 
     if not token or not chat_id:
-        print("[TG] TG_BOT_TOKEN или TG_CHAT_ID не заданы — не отправляем.")
+        logger.debug("[TG] TG_BOT_TOKEN или TG_CHAT_ID не заданы — не отправляем.")
         return
 
-    try:
-        resp = requests.post(
-            f"https://api.telegram.org/bot{token}/sendMessage",
-            json={"chat_id": chat_id, "text": text},
-            timeout=10,
-        )
-        print("[TG] status:", resp.status_code, "raw:", resp.text[:500])
-    except Exception as e:
-        print("[TG] ERROR:", repr(e))
+    async with TG_SEM:
+        try:
+            resp = await HTTPX.post(
+                f"https://api.telegram.org/bot{token}/sendMessage",
+                json={"chat_id": chat_id, "text": text},
+                timeout=10,
+            )
+            logger.debug("[TG] status: %s", resp.status_code)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[TG] raw: %s", resp.text[:500])
+        except Exception as e:
+            logger.error("[TG] ERROR: %r", e)
 
 
 # ================== ГЛАВНАЯ ЛОГИКА ОБРАБОТКИ АКТИВНОСТИ ==================
 
 
-def process_activity(athlete_id: int, activity_id: int):
-    print("=== PROCESS START ===")
-    print(f"owner={athlete_id} activity={activity_id}")
+async def process_activity(athlete_id: int, activity_id: int):
+    logger.info("[PROCESS] start owner=%s activity=%s", athlete_id, activity_id)
 
     # 1) берём токен
     try:
-        token = get_access_token(athlete_id)
-        print("[PROCESS] access token OK")
+        token = await get_access_token(athlete_id)
+        logger.debug("[PROCESS] access token OK")
     except KeyError:
-        print(f"[PROCESS] SKIP: нет токена для owner={athlete_id}. Надо пройти OAuth.")
+        logger.warning(
+            "[PROCESS] SKIP: нет токена для owner=%s. Надо пройти OAuth.", athlete_id
+        )
         return
     except Exception as e:
-        print("[PROCESS] ERROR get_access_token:", repr(e))
+        logger.error("[PROCESS] ERROR get_access_token: %r", e)
         return
 
-    headers = {"Authorization": f"Bearer {token}"}
-
-    # 2) детальная активность
-    try:
-        r_act = requests.get(
-            f"{STRAVA_API}/activities/{activity_id}",
-            headers=headers,
-            timeout=15,
-        )
-        print("[STRAVA] /activities status:", r_act.status_code)
-        print("[STRAVA] /activities raw:", r_act.text[:500])
-        if r_act.status_code != 200:
-            print("[STRAVA] ERROR: не смогли получить активность")
-            return
-        activity = r_act.json()
-    except Exception as e:
-        print("[PROCESS] ERROR fetching activity:", repr(e))
+    # 2) детальная активность и список для сводки — параллельно,
+    #    оба запроса идут потоками по одному HTTP/2-соединению
+    activity, week_summary = await asyncio.gather(
+        fetch_activity(activity_id, token),
+        fetch_week_summary(athlete_id, token),
+        return_exceptions=True,
+    )
+    if isinstance(activity, Exception):
+        logger.error("[PROCESS] ERROR fetching activity: %r", activity)
         return
 
     # 2a) проверка, что это не мусорная активность
     if not is_moving_activity(activity):
-        print(f"[PROCESS] SKIP activity {activity_id}: без движения / слишком короткая")
+        logger.info("[PROCESS] SKIP activity %s: без движения / слишком короткая", activity_id)
         return
 
-    # 3) список активностей для сводки
-    try:
-        r_list = requests.get(
-            f"{STRAVA_API}/athlete/activities",
-            headers=headers,
-            params={"per_page": 50},
-            timeout=15,
-        )
-        print("[STRAVA] /athlete/activities status:", r_list.status_code)
-        if r_list.status_code != 200:
-            print("[STRAVA] ERROR: не смогли получить список активностей")
-            acts: List[Dict[str, Any]] = []
-        else:
-            acts = r_list.json()
-            print(f"[STRAVA] /athlete/activities count={len(acts)}")
-    except Exception as e:
-        print("[PROCESS] ERROR fetching activities list:", repr(e))
-        acts = []
-
-    week_summary = summarize_week(acts)
+    # 3) сводка по списку активностей
+    if isinstance(week_summary, Exception):
+        logger.warning("[PROCESS] ERROR fetching activities list: %r", week_summary)
+        week_summary = summarize_week([])
 
     # 4) формируем промпт
     try:
         prompt = build_coach_prompt(activity, week_summary)
-        print("=== GPT PROMPT PREVIEW ===")
-        print(prompt[:800])
-        print("=== END PROMPT PREVIEW ===")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[PROCESS] prompt preview:\n%s", prompt[:800])
     except Exception as e:
-        print("[PROCESS] ERROR build_coach_prompt:", repr(e))
+        logger.error("[PROCESS] ERROR build_coach_prompt: %r", e)
         return
 
     # 5) вызываем GPT
-    advice = ask_openai(prompt)
-    print("=== COACH ADVICE ===")
-    print(advice)
-    print("====================")
+    advice = await ask_openai(prompt)
+    logger.debug("[PROCESS] coach advice:\n%s", advice)
 
     # 6) отправляем в Telegram (если настроен)
     name = activity.get("name")
     atype = activity.get("type")
     msg = f"Новая тренировка: {name} — {atype}\n\nСовет:\n{advice}"
-    send_tg(msg)
+    # ответ Telegram не нужен — не ждём его
+    spawn(send_tg(msg))
 
-    print("=== PROCESS END ===")
+    logger.info("[PROCESS] end owner=%s activity=%s", athlete_id, activity_id)
 
 
 # ================== ПЛАН НА НЕДЕЛЮ ПО URL ==================
 
 
 @app.get("/plan/weekly")
-def weekly_plan():
+async def weekly_plan():
     """
     Ручной триггер: дергаешь URL → в Телеграм прилетает план на неделю,
     построенный по последним тренировкам + цели (COACH_GOAL).
     """
-    if not TOKENS:
+    try:
+        athlete_id = await any_athlete_id()
+    except Exception as e:
+        logger.error("[PLAN] ERROR token store: %r", e)
+        return PlainTextResponse("Ошибка хранилища токенов", status_code=500)
+    if athlete_id is None:
         return PlainTextResponse(
             "Нет подключённого атлета (надо пройти OAuth через Strava).",
             status_code=400,
         )
 
-    athlete_id = list(TOKENS.keys())[0]
-    print("[PLAN] using athlete_id:", athlete_id)
+    logger.info("[PLAN] using athlete_id: %s", athlete_id)
 
     try:
-        token = get_access_token(athlete_id)
+        token = await get_access_token(athlete_id)
     except Exception as e:
-        print("[PLAN] ERROR get_access_token:", repr(e))
+        logger.error("[PLAN] ERROR get_access_token: %r", e)
         return PlainTextResponse("Ошибка токена Strava", status_code=500)
 
-    headers = {"Authorization": f"Bearer {token}"}
     try:
-        r_list = requests.get(
-            f"{STRAVA_API}/athlete/activities",
-            headers=headers,
-            params={"per_page": 50},
-            timeout=15,
-        )
-        print("[PLAN] /athlete/activities status:", r_list.status_code)
-        r_list.raise_for_status()
-        acts = r_list.json()
+        week_summary = await fetch_week_summary(athlete_id, token)
     except Exception as e:
-        print("[PLAN] ERROR fetching activities:", repr(e))
+        logger.error("[PLAN] ERROR fetching activities: %r", e)
         return PlainTextResponse("Ошибка при запросе к Strava", status_code=500)
-
-    week_summary = summarize_week(acts)
     goal = os.getenv("COACH_GOAL", "цель не указана")
 
-    prompt = f"""
-Ты тренер по выносливости. На основе последних тренировок (сводка ниже)
-и цели атлета составь план на следующую неделю (5–7 дней).
+    prompt = _WEEKLY_PROMPT.format(goal=goal, week=week_summary)
 
-ЦЕЛЬ: {goal}
+    advice = await ask_openai(prompt)
+    await send_tg("📅 План на неделю:\n" + advice)
 
-СВОДКА НЕДЕЛИ: {week_summary}
+    return PlainTextResponse("План отправлен в Telegram ✅")
 
-Выведи по дням:
-- ДЕНЬ недели,
-- тип тренировки,
-- длительность,
-- интенсивность (зона / RPE),
-- если нужен отдых — так и напиши.
-""".strip()
 
-    advice = ask_openai(prompt)
-    send_tg("📅 План на неделю:\n" + advice)
+if __name__ == "__main__":
+    import uvicorn
 
-    return PlainTextResponse("План отправлен в Telegram ✅")
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        # auto = uvloop/httptools, если установлены (на Windows uvloop нет)
+        loop="auto",
+        http="auto",
+    )